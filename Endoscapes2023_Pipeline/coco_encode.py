@@ -0,0 +1,76 @@
+import numpy as np
+from pycocotools import mask as maskUtils
+
+from utils import masks_to_bboxes
+
+# This module is imported by the spawned workers of save_as_coco_format in
+# inference.py; it must not import torch, so that the workers neither load it
+# nor initialize CUDA.
+
+
+def drop_empty_masks(segment):
+    """
+    Drop the categories of a frame segment whose mask is empty.
+
+    Args:
+        segment (tuple): Category IDs (C,), masks (C, H, W) and scores (C,).
+
+    Returns:
+        tuple: Segment of the same layout, or None if every mask is empty.
+    """
+    cat_ids, masks, scores = segment
+    nonempty = masks.reshape(len(masks), -1).any(axis=1)
+    if not nonempty.any():
+        return None
+    return cat_ids[nonempty], masks[nonempty], scores[nonempty]
+
+
+def encode_frame(image_id, segment):
+    """
+    Encode the segment of one frame into COCO annotations.
+
+    Args:
+        image_id (int): Image ID of the frame.
+        segment (tuple): Category IDs, non-empty masks and scores of the frame.
+
+    Returns:
+        list: Annotations of the frame.
+    """
+    # the masks are already merged by category in predict_on_video
+    cat_ids, masks, scores = segment
+
+    # encode all masks of the frame in one call on a (H, W, K) Fortran array
+    rles = maskUtils.encode(np.asfortranarray(masks.transpose(1, 2, 0)))
+    bboxes = masks_to_bboxes(masks)
+
+    annotations = []
+    for key, bbox, score, rle in zip(
+        cat_ids.tolist(), bboxes.tolist(), scores.tolist(), rles
+    ):
+        rle["counts"] = rle["counts"].decode("utf-8")
+        annotation = {
+            "image_id": image_id,
+            "category_id": key,
+            "segmentation": rle,
+            "bbox": bbox,  # 添加 bbox 字段
+            "iscrowd": 0,
+            "score": score,  # 添加 score 字段
+        }
+        annotations.append(annotation)
+    return annotations
+
+
+def encode_frames(frames):
+    """
+    Encode a chunk of frames into COCO annotations, in order.
+
+    Args:
+        frames (list): (image_id, segment) pairs, as taken by `encode_frame`.
+
+    Returns:
+        list: Annotations of all frames of the chunk.
+    """
+    annotations = []
+    for image_id, segment in frames:
+        annotations.extend(encode_frame(image_id, segment))
+    return annotations
@@ -1,10 +1,13 @@
 import yaml
 import multiprocessing
-from inference import inference
 from loguru import logger
 
 
 if __name__ == "__main__":
+    # imported here so that spawned processes, which re-import this module as
+    # __mp_main__, do not load torch unless they need it
+    from inference import inference
+
     multiprocessing.set_start_method("spawn")
     logger.add("logs/ex.log", mode="w")
     with open("config.yaml", "r") as f:
@@ -1,36 +1,61 @@
+import hashlib
 import json
+import multiprocessing
 import os
 import pickle
 import random
-import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Set
 
+# Let the CUDA caching allocator grow segments in place instead of handing memory
+# back to the driver between clips; must be set before torch initializes CUDA.
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512"
+)
+
+import cv2
 import numpy as np
 import torch
+import torchvision
 from icecream import ic
 from loguru import logger
 from pycocotools import mask as maskUtils
 from pycocotools.coco import COCO
 from sam2.build_sam import build_sam2_video_predictor
 
+from coco_encode import drop_empty_masks, encode_frames
 from PromptObjNoiseAdder import PromptObjNoiseAdder
 from utils import (
     ClipRange,
+    ObjBatch,
     PromptInfo,
-    PromptObj,
-    mask_to_bbox,
-    mask_to_masks,
+    mask_to_components,
     mask_to_points,
 )
 
 # ic.disable()
-# Enable autocast for mixed precision on CUDA devices
-torch.autocast(device_type="cuda", dtype=torch.bfloat16).__enter__()
+# Cap the share of GPU memory this process may take (e.g. 0.9 on a shared GPU);
+# None leaves the whole device to the caching allocator.
+CUDA_MEMORY_FRACTION = None
+
+
+def setup_torch():
+    """
+    Configure torch for inference on the GPU.
 
-# Enable TensorFloat32 (tf32) for Ampere GPUs
-if torch.cuda.get_device_properties(0).major >= 8:
-    torch.backends.cuda.matmul.allow_tf32 = True
-    torch.backends.cudnn.allow_tf32 = True
+    Called by inference() rather than at import, so that the spawned encoding
+    workers, which re-import the main module, do not initialize CUDA.
+    """
+    # Enable autocast for mixed precision on CUDA devices
+    torch.autocast(device_type="cuda", dtype=torch.bfloat16).__enter__()
+
+    # Enable TensorFloat32 (tf32) for Ampere GPUs
+    if torch.cuda.get_device_properties(0).major >= 8:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
+    if CUDA_MEMORY_FRACTION is not None:
+        torch.cuda.set_per_process_memory_fraction(CUDA_MEMORY_FRACTION)
 
 
 # Path to the SAM2 checkpoint and model configuration
@@ -39,6 +64,24 @@ sam2_checkpoint = (
 )
 model_cfg = "sam2_hiera_t.yaml"
 
+# Number of JPEG frames decoded per NVJPEG call
+JPEG_DECODE_BATCH_SIZE = 64
+# decode_jpeg accepts a list of images on the GPU from torchvision 0.19 on
+_BATCHED_JPEG_DECODE = tuple(
+    int(v) for v in torchvision.__version__.split("+")[0].split(".")[:2]
+) >= (0, 19)
+# Number of frames whose masks can be in flight to the host at the same time
+MASK_STAGING_SLOTS = 8
+# Directory next to the annotation file holding its pickled COCO object, reused
+# while the annotation file is unchanged
+COCO_CACHE_DIRNAME = ".coco_cache"
+# Worker processes and frames per task for the RLE encoding. Outputs with fewer
+# frames than ENCODE_PARALLEL_MIN_FRAMES are encoded in this process, as a
+# spawned worker takes about a second to start.
+ENCODE_WORKERS = min(8, os.cpu_count() or 1)
+ENCODE_CHUNKSIZE = 64
+ENCODE_PARALLEL_MIN_FRAMES = 1000
+
 ######################
 #
 # torch initialize
@@ -50,6 +93,7 @@ PROMPT_INFO = []
 OUTPUT_PATH = None
 VIDEO_ID_SET = set()
 COCO_INFO = None
+ANN_BY_IMG = {}
 OBJ_COUNT = 0
 MOD = None
 NOISED_PROMPT = False
@@ -99,6 +143,44 @@ def sort_dicts_by_field(data, field_name, reverse=False):
     return sorted(data, key=lambda item: item.get(field_name), reverse=reverse)
 
 
+def load_coco(coco_path):
+    """
+    Load a COCO dataset, reusing a pickled copy while the file is unchanged.
+
+    The pickle is kept in COCO_CACHE_DIRNAME next to the annotation file; if
+    that directory is not writable, the file is parsed without caching.
+
+    Args:
+        coco_path (str): Path to COCO annotations file.
+
+    Returns:
+        COCO: COCO dataset object.
+    """
+    coco_path = os.path.abspath(coco_path)
+    stat = os.stat(coco_path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cache_dir = os.path.join(os.path.dirname(coco_path), COCO_CACHE_DIRNAME)
+    key = hashlib.sha1(coco_path.encode("utf-8")).hexdigest()
+    cache_path = os.path.join(cache_dir, f"{key}.pkl")
+
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            cached_stamp, coco_info = pickle.load(f)
+        if cached_stamp == stamp:
+            return coco_info
+
+    coco_info = COCO(coco_path)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            pickle.dump((stamp, coco_info), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning(f"cannot cache COCO annotations in {cache_dir}: {e}")
+    return coco_info
+
+
 def get_imgs(coco_info):
     """
     Get images from COCO dataset.
@@ -142,9 +224,7 @@ def find_prompt_frame(frames, clip_range: ClipRange):
         if frame["order_in_video"] < clip_start or frame["order_in_video"] > clip_end:
             continue
 
-        ann_ids = COCO_INFO.getAnnIds(imgIds=frame["id"])
-
-        if ann_ids == []:
+        if not ANN_BY_IMG.get(frame["id"]):
             continue
 
         return frame
@@ -152,26 +232,115 @@ def find_prompt_frame(frames, clip_range: ClipRange):
     return None
 
 
-def create_symbol_link_for_video(frames_info):
+def index_annotations_by_image(frames):
+    """
+    Group the annotations of the given frames by image id.
+
+    Args:
+        frames (list): List of frame information.
+
+    Returns:
+        dict: Mapping from image id to the list of its annotations.
+    """
+    ann_by_img = {}
+    ann_ids = COCO_INFO.getAnnIds(imgIds=[frame["id"] for frame in frames])
+    for ann in COCO_INFO.loadAnns(ann_ids):
+        ann_by_img.setdefault(ann["image_id"], []).append(ann)
+    return ann_by_img
+
+
+def _decode_jpeg_batch_on_gpu(data):
+    """Decode a list of encoded JPEGs with NVJPEG, batched when supported."""
+    if _BATCHED_JPEG_DECODE:
+        return torchvision.io.decode_jpeg(
+            data, mode=torchvision.io.ImageReadMode.RGB, device="cuda"
+        )
+    return [
+        torchvision.io.decode_jpeg(
+            image, mode=torchvision.io.ImageReadMode.RGB, device="cuda"
+        )
+        for image in data
+    ]
+
+
+def _decode_frames_on_gpu(frames_info):
     """
-    Create symbolic links for video frames in a temporary directory.
+    Decode JPEG frames in batches with NVJPEG into pinned host memory.
+
+    Only one batch of decoded frames is held on the GPU at a time; the video
+    itself is kept on the host and each clip is uploaded when it is loaded.
 
     Args:
         frames_info (list): List of frame information.
 
     Returns:
-        str: Path to the temporary directory.
+        torch.Tensor: RGB frames of shape (F, 3, H, W) in pinned memory.
+    """
+    frames_tensor = None
+    for start in range(0, len(frames_info), JPEG_DECODE_BATCH_SIZE):
+        batch = frames_info[start : start + JPEG_DECODE_BATCH_SIZE]
+        data = [torchvision.io.read_file(frame["path"]) for frame in batch]
+        images = torch.stack(_decode_jpeg_batch_on_gpu(data))
+        if frames_tensor is None:
+            _, _, height, width = images.shape
+            frames_tensor = torch.empty(
+                (len(frames_info), 3, height, width),
+                dtype=torch.uint8,
+                pin_memory=True,
+            )
+        frames_tensor[start : start + len(batch)].copy_(images)
+
+    return frames_tensor
+
+
+def _decode_frames_on_cpu(frames_info):
     """
-    video_dir = tempfile.mkdtemp()
-    current_dir = os.getcwd()
+    Decode frames with OpenCV into pinned host memory.
 
+    Args:
+        frames_info (list): List of frame information.
+
+    Returns:
+        torch.Tensor: RGB frames of shape (F, 3, H, W) in pinned memory.
+    """
+    frames_tensor = None
     for idx, frame in enumerate(frames_info):
-        frame_name = str(idx).zfill(8)  # 填充到5位宽度
-        dst_path = os.path.join(video_dir, f"{frame_name}.jpg")
-        src_path = os.path.join(current_dir, frame["path"])
-        os.symlink(src_path, dst_path)
+        image = cv2.imread(frame["path"], cv2.IMREAD_COLOR)
+        if image is None:
+            raise RuntimeError(f"failed to read frame {frame['path']}")
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if frames_tensor is None:
+            height, width = image.shape[:2]
+            frames_tensor = torch.empty(
+                (len(frames_info), 3, height, width),
+                dtype=torch.uint8,
+                pin_memory=True,
+            )
+        frames_tensor[idx] = torch.from_numpy(image).permute(2, 0, 1)
+
+    return frames_tensor
 
-    return video_dir
+
+def load_frames_to_tensor(frames_info):
+    """
+    Decode every frame of a video once into a pinned uint8 tensor.
+
+    JPEG frames are decoded on the GPU with NVJPEG when CUDA is available;
+    otherwise OpenCV is used. Either way the video is kept in host memory.
+
+    Args:
+        frames_info (list): List of frame information.
+
+    Returns:
+        torch.Tensor: RGB frames of shape (F, 3, H, W).
+    """
+    is_jpeg = all(
+        os.path.splitext(frame["path"])[-1].lower() in (".jpg", ".jpeg")
+        for frame in frames_info
+    )
+    if is_jpeg and torch.cuda.is_available():
+        return _decode_frames_on_gpu(frames_info)
+    return _decode_frames_on_cpu(frames_info)
 
 
 def fluctuate_point(point, beta, width, height):
@@ -331,22 +500,31 @@ def get_each_obj(prompt_frame, cats: Set[int] = None, beta=10):
         cats (Set[int]): Set of category IDs to filter by.
 
     Returns:
-        list: List of objects.
+        ObjBatch: Batch of objects.
     """
     global OBJ_COUNT
-    ann_ids = COCO_INFO.getAnnIds(imgIds=prompt_frame["id"])
-    anns = COCO_INFO.loadAnns(ann_ids)
+    anns = [
+        ann
+        for ann in ANN_BY_IMG.get(prompt_frame["id"], [])
+        if cats is None or ann["category_id"] in cats
+    ]
 
-    objs = []
+    all_mask = []
+    all_bbox = []
+    all_points = []
+    all_labels = []
+    all_obj_id = []
 
-    for ann in anns:
-        if cats is not None and ann["category_id"] not in cats:
-            continue
-        rle = ann["segmentation"]
-        raw_mask = maskUtils.decode(rle)  # 将RLE解码为二进制掩码
-        masks = mask_to_masks(raw_mask)
+    raw_masks = []
+    if anns:
+        # 将RLE解码为二进制掩码, all annotations in one call: (H, W, K) -> (K, H, W)
+        raw_masks = maskUtils.decode([ann["segmentation"] for ann in anns])
+        raw_masks = np.ascontiguousarray(raw_masks.transpose(2, 0, 1))
+
+    for ann, raw_mask in zip(anns, raw_masks):
+        masks, bboxes = mask_to_components(raw_mask)
 
-        for mask in masks:
+        for mask, bbox in zip(masks, bboxes):
             obj_id = OBJ_COUNT * MOD + ann["category_id"]
             # logger.info(f"num_points: {type(num_points)}")
             pos_points = mask_to_points(
@@ -360,21 +538,27 @@ def get_each_obj(prompt_frame, cats: Set[int] = None, beta=10):
                 include_center=False,
             )
 
-            pos_labels = np.ones(len(pos_points))
-            neg_labels = np.zeros(len(negative_points))
+            # int32 labels match what SAM2 expects and skip a cast there
+            pos_labels = np.ones(len(pos_points), dtype=np.int32)
+            neg_labels = np.zeros(len(negative_points), dtype=np.int32)
 
-            obj = PromptObj(
-                mask=mask,
-                bbox=mask_to_bbox(mask),
-                points=np.concatenate([pos_points, negative_points]),
-                obj_id=obj_id,
-                pos_or_neg_label=np.concatenate([pos_labels, neg_labels]),
-            )
-            objs.append(obj)
+            all_mask.append(mask)
+            all_bbox.append(bbox)
+            all_points.append(np.concatenate([pos_points, negative_points]))
+            all_labels.append(np.concatenate([pos_labels, neg_labels]))
+            all_obj_id.append(obj_id)
 
             OBJ_COUNT += 1
 
-    return objs
+    return ObjBatch.stack(
+        all_mask,
+        all_bbox,
+        all_points,
+        all_labels,
+        all_obj_id,
+        prompt_frame["height"],
+        prompt_frame["width"],
+    )
 
 
 def get_obj_from_masks(video_segment):
@@ -382,34 +566,44 @@ def get_obj_from_masks(video_segment):
     Extract objects from video segments.
 
     Args:
-        video_segment (dict): Dictionary containing video segments.
+        video_segment (tuple): Category IDs, masks and scores of a frame.
 
     Returns:
-        list: List of objects.
+        ObjBatch: Batch of objects.
     """
-    objs = []
-    for obj_id, obj_seg in video_segment.items():
-        if obj_seg["mask"].sum() == 0:
+    all_mask = []
+    all_bbox = []
+    all_points = []
+    all_labels = []
+    all_obj_id = []
+    cat_ids, seg_masks, _ = video_segment
+    height, width = seg_masks.shape[-2:]
+    for obj_id, seg_mask in zip(cat_ids.tolist(), seg_masks):
+        if not seg_mask.any():
             continue
 
-        masks = mask_to_masks(np.squeeze(obj_seg["mask"], axis=0))
-        for mask in masks:
-            bbox = mask_to_bbox(mask)
+        masks, bboxes = mask_to_components(seg_mask)
+        for mask, bbox in zip(masks, bboxes):
             points = mask_to_points(mask)
-            obj = PromptObj(
-                mask=mask,
-                bbox=bbox,
-                points=points,
-                obj_id=obj_id,
-                pos_or_neg_label=np.ones(len(points)),
-            )
-            objs.append(obj)
-
-    return objs
+            all_mask.append(mask)
+            all_bbox.append(bbox)
+            all_points.append(points)
+            all_labels.append(np.ones(len(points), dtype=np.int32))
+            all_obj_id.append(obj_id)
+
+    return ObjBatch.stack(
+        all_mask,
+        all_bbox,
+        all_points,
+        all_labels,
+        all_obj_id,
+        height,
+        width,
+    )
 
 
 def add_prompt(
-    prompt_objs: List[PromptObj],
+    prompt_objs: ObjBatch,
     predictor,
     inference_state,
     prompt_frame_order_in_video,
@@ -419,7 +613,7 @@ def add_prompt(
     Add prompts to the predictor.
 
     Args:
-        prompt_objs (list): List of prompt objects.
+        prompt_objs (ObjBatch): Batch of prompt objects.
         predictor (object): Predictor object.
         inference_state (object): Inference state object.
         prompt_frame_order_in_video (int): Order of the prompt frame in the video.
@@ -428,77 +622,246 @@ def add_prompt(
     Returns:
         tuple: Updated predictor, inference state, object IDs, and mask logits.
     """
-    for obj in prompt_objs:
+    frame_idx = prompt_frame_order_in_video
+
+    def _add_points(i, obj):
+        return predictor.add_new_points_or_box(
+            inference_state=inference_state,
+            frame_idx=frame_idx,
+            obj_id=obj.obj_id,
+            points=obj.points,
+            labels=obj.pos_or_neg_label,
+        )
+
+    def _add_bbox(i, obj):
+        return predictor.add_new_points_or_box(
+            inference_state=inference_state,
+            frame_idx=frame_idx,
+            obj_id=obj.obj_id,
+            box=obj.bbox,
+        )
+
+    def _add_mask(i, obj):
+        if NOISED_PROMPT:
+            mask_tensor = torch.from_numpy(obj.mask).to(torch.bool)
+        else:
+            mask_tensor = mask_batch[i]
+        return predictor.add_new_mask(
+            inference_state=inference_state,
+            frame_idx=frame_idx,
+            obj_id=obj.obj_id,
+            mask=mask_tensor,
+        )
+
+    add_fn = {"points": _add_points, "bbox": _add_bbox, "mask": _add_mask}[prompt_type]
+
+    if prompt_type == "mask" and not NOISED_PROMPT:
+        # upload all the masks at once and index the rows on device
+        mask_batch = torch.from_numpy(prompt_objs.masks).to(
+            inference_state["device"], dtype=torch.bool, non_blocking=True
+        )
+
+    for i in range(len(prompt_objs)):
+        obj = prompt_objs[i]
         if NOISED_PROMPT:
             obj = NOISE_ADDER.add_noise_to_obj(obj, prompt_type)
             if obj is None:
                 continue
-        match prompt_type:
-            case "points":
-                _, out_obj_ids, out_mask_logits = predictor.add_new_points_or_box(
-                    inference_state=inference_state,
-                    frame_idx=prompt_frame_order_in_video,
-                    obj_id=obj.obj_id,
-                    points=obj.points,
-                    labels=obj.pos_or_neg_label,
-                )
-            case "bbox":
-                _, out_obj_ids, out_mask_logits = predictor.add_new_points_or_box(
-                    inference_state=inference_state,
-                    frame_idx=prompt_frame_order_in_video,
-                    obj_id=obj.obj_id,
-                    box=obj.bbox,
-                )
-            case "mask":
-                mask_tensor = torch.from_numpy(obj.mask).to(torch.bool)
-                _, out_obj_ids, out_mask_logits = predictor.add_new_mask(
-                    inference_state=inference_state,
-                    frame_idx=prompt_frame_order_in_video,
-                    obj_id=obj.obj_id,
-                    mask=mask_tensor,
-                )
+            # keep the noised prompt so that it is the one saved in prompt.pkl
+            prompt_objs[i] = obj
+        _, out_obj_ids, out_mask_logits = add_fn(i, obj)
 
     return predictor, inference_state, out_obj_ids, out_mask_logits
 
 
-def predict_on_video(predictor, inference_state, start_idx):
+def collect_frame_outputs(out_obj_ids, out_mask_logits):
+    """
+    Merge the masks of a frame by category on the GPU.
+
+    Object masks are OR-ed per category (obj_id % MOD) as uint8, so only one
+    mask per category has to be transferred. All categories get the score of
+    the last object of the frame.
+
+    Args:
+        out_obj_ids (list): Object IDs of the frame.
+        out_mask_logits (torch.Tensor): Mask logits of shape (K, 1, H, W).
+
+    Returns:
+        tuple: Category IDs, mask tensor (C, H, W) uint8 and score tensor (C,),
+            both on the device of the logits.
+    """
+    device = out_mask_logits.device
+    num_objs = len(out_obj_ids)
+    height, width = out_mask_logits.shape[-2:]
+
+    categories = sorted({obj_id % MOD for obj_id in out_obj_ids})
+    cat_pos = {cat: i for i, cat in enumerate(categories)}
+    group_idx = torch.tensor(
+        [cat_pos[obj_id % MOD] for obj_id in out_obj_ids], device=device
+    )
+
+    # amax over 0/1 uint8 values is a bitwise or
+    masks_u8 = (out_mask_logits > 0.0).to(torch.uint8).view(num_objs, -1)
+    masks = torch.zeros(
+        (len(categories), height * width), dtype=torch.uint8, device=device
+    )
+    masks.scatter_reduce_(
+        0, group_idx[:, None].expand_as(masks_u8), masks_u8, reduce="amax"
+    )
+
+    # 使用 sigmoid 转换为概率，取最大值作为 score
+    # The last object's score is deliberately reused for every category of the
+    # frame, to stay compatible with the scores the host-side merge wrote.
+    score = torch.sigmoid(out_mask_logits[-1]).amax()
+    scores = score.expand(len(categories))
+
+    return categories, masks.view(-1, height, width), scores
+
+
+class MaskStaging:
+    """
+    Pinned host buffers reused for the device-to-host copies of frame masks.
+
+    The slots are used round-robin. A slot is only read back, after waiting
+    for its own copy, when it is about to be reused or when the clip is
+    flushed, so the propagation loop never blocks on the latest frame.
+
+    A drained slot is copied into the host buffer of its frame, shared by all
+    clips of the video, and the frame's segment is a view into that buffer.
+    Both are sized by the number of categories of the video: the pinned ring
+    takes num_slots * num_cats * H * W bytes for the masks, and the frame
+    buffer num_frames * num_cats * H * W bytes, only touched for tracked
+    frames.
+    """
+
+    def __init__(self, num_slots, num_frames, num_cats, height, width):
+        self.masks = torch.empty(
+            (num_slots, num_cats, height, width), dtype=torch.uint8, pin_memory=True
+        )
+        self.scores = torch.empty(
+            (num_slots, num_cats), dtype=torch.float32, pin_memory=True
+        )
+        self.frame_masks = np.empty((num_frames, num_cats, height, width), np.uint8)
+        self.frame_scores = np.empty((num_frames, num_cats), np.float32)
+        self.events = [torch.cuda.Event() for _ in range(num_slots)]
+        self.pending = [None] * num_slots  # (frame_idx, categories) per slot
+        self.next_slot = 0
+
+    def push(self, frame_idx, categories, masks, scores, video_segments):
+        """Start copying a frame's outputs into the next slot."""
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % len(self.pending)
+        self._drain(slot, video_segments)
+
+        num_cats = len(categories)
+        self.masks[slot, :num_cats].copy_(masks, non_blocking=True)
+        self.scores[slot, :num_cats].copy_(scores, non_blocking=True)
+        self.events[slot].record()
+        self.pending[slot] = (frame_idx, categories)
+
+    def flush(self, video_segments):
+        """Read back every slot that is still pending, oldest first."""
+        num_slots = len(self.pending)
+        for offset in range(num_slots):
+            self._drain((self.next_slot + offset) % num_slots, video_segments)
+
+    def _drain(self, slot, video_segments):
+        if self.pending[slot] is None:
+            return
+        frame_idx, categories = self.pending[slot]
+        self.pending[slot] = None
+        self.events[slot].synchronize()
+
+        num_cats = len(categories)
+        frame_masks = self.frame_masks[frame_idx, :num_cats]
+        frame_scores = self.frame_scores[frame_idx, :num_cats]
+        np.copyto(frame_masks, self.masks[slot, :num_cats].numpy())
+        np.copyto(frame_scores, self.scores[slot, :num_cats].numpy())
+        video_segments[frame_idx] = (
+            np.asarray(categories, dtype=np.int64),
+            frame_masks,
+            frame_scores,
+        )
+
+
+def _trim_state(inference_state, frame_idx, reverse, keep_last):
+    """
+    Drop the non-conditioning output that just fell out of the memory window.
+
+    SAM2 only reads the outputs of the last `keep_last` tracked frames (memory
+    frames and object pointers), so older ones are released to keep the state
+    bounded. Frames close to a conditioning frame are kept, as the pass in the
+    other direction starts from there and reads them as memory.
+
+    Args:
+        inference_state (object): Inference state object.
+        frame_idx (int): Frame that was just tracked.
+        reverse (bool): Whether tracking runs in reverse time order.
+        keep_last (int): Number of most recent frames to keep.
+    """
+    stale_idx = frame_idx + keep_last + 1 if reverse else frame_idx - keep_last - 1
+    output_dict = inference_state["output_dict"]
+    consolidated_frame_inds = inference_state["consolidated_frame_inds"]
+    if stale_idx in consolidated_frame_inds["non_cond_frame_outputs"]:
+        return
+    if any(abs(stale_idx - t) <= keep_last for t in output_dict["cond_frame_outputs"]):
+        return
+
+    output_dict["non_cond_frame_outputs"].pop(stale_idx, None)
+    for obj_output_dict in inference_state["output_dict_per_obj"].values():
+        obj_output_dict["non_cond_frame_outputs"].pop(stale_idx, None)
+
+
+def predict_on_video(
+    predictor, inference_state, start_idx, prompt_frame_idx, mask_staging
+):
     """
     Predict segmentation masks for the video.
 
+    Only the directions that have frames to track are propagated: the reverse
+    pass is skipped when the prompt frame is the first frame of the clip and the
+    forward pass when it is the last one. The passes only share the prompt
+    frame, whose stored outputs are the same in both; the later pass wins.
+
     Args:
         predictor (object): Predictor object.
         inference_state (object): Inference state object.
         start_idx (int): Start index of the video.
+        prompt_frame_idx (int): Index of the earliest prompt frame in the clip.
+        mask_staging (MaskStaging): Pinned buffers for the host copies.
 
     Returns:
-        dict: Dictionary containing video segments.
+        dict: Per-frame segments as a tuple of category IDs (C,), merged masks
+            (C, H, W) uint8 and scores (C,).
     """
-    video_segments = {}
+    last_frame_idx = inference_state["num_frames"] - 1
+    directions = []
+    if prompt_frame_idx > 0:
+        directions.append(True)
+    if prompt_frame_idx < last_frame_idx or not directions:
+        directions.append(False)
+
+    # farthest frame SAM2 looks back at, for object pointers or memory frames
+    keep_last = max(
+        predictor.max_obj_ptrs_in_encoder,
+        predictor.num_maskmem * predictor.memory_temporal_stride_for_eval,
+    )
+
     # video_segments contains the per-frame segmentation results
-    for out_frame_idx, out_obj_ids, out_mask_logits in predictor.propagate_in_video(
-        inference_state, reverse=True
-    ):
-        video_segments[out_frame_idx + start_idx] = {
-            out_obj_id: {
-                "mask": (out_mask_logits[i] > 0.0).cpu().numpy(),
-                "score": torch.sigmoid(out_mask_logits[i])
-                .max()
-                .item(),  # 使用 sigmoid 转换为概率，取最大值作为 score
-            }
-            for i, out_obj_id in enumerate(out_obj_ids)
-        }
-    for out_frame_idx, out_obj_ids, out_mask_logits in predictor.propagate_in_video(
-        inference_state
-    ):
-        video_segments[out_frame_idx + start_idx] = {
-            out_obj_id: {
-                "mask": (out_mask_logits[i] > 0.0).cpu().numpy(),
-                "score": torch.sigmoid(out_mask_logits[i])
-                .max()
-                .item(),  # 使用 sigmoid 转换为概率，取最大值作为 score
-            }
-            for i, out_obj_id in enumerate(out_obj_ids)
-        }
+    video_segments = {}
+    for reverse in directions:
+        for out_frame_idx, out_obj_ids, out_mask_logits in predictor.propagate_in_video(
+            inference_state, reverse=reverse
+        ):
+            categories, masks, scores = collect_frame_outputs(
+                out_obj_ids, out_mask_logits
+            )
+            mask_staging.push(
+                out_frame_idx + start_idx, categories, masks, scores, video_segments
+            )
+            _trim_state(inference_state, out_frame_idx, reverse, keep_last)
+
+    mask_staging.flush(video_segments)
     return video_segments
 
 
@@ -515,12 +878,20 @@ def save_prompt_frame(
     PROMPT_INFO.extend(clip_prompts)
 
 
-def process_video_clip(frames, clip_prompts: List[PromptInfo], clip_range: ClipRange):
+def process_video_clip(
+    predictor,
+    frames_tensor,
+    mask_staging,
+    clip_prompts: List[PromptInfo],
+    clip_range: ClipRange,
+):
     """
     Process a video clip.
 
     Args:
-        frames (list): List of frame information.
+        predictor (object): Predictor object shared by all clips.
+        frames_tensor (torch.Tensor): Preloaded frames of the whole video.
+        mask_staging (MaskStaging): Pinned buffers for the host copies.
         clip_prompts (List[PromptInfo]): List of prompt information.
         clip_range (ClipRange): Range of the clip.
 
@@ -530,10 +901,9 @@ def process_video_clip(frames, clip_prompts: List[PromptInfo], clip_range: ClipR
     start_idx = clip_range.start_idx
     end_idx = clip_range.end_idx
 
-    video_dir = create_symbol_link_for_video(frames[start_idx : end_idx + 1])
-
-    predictor = build_sam2_video_predictor(model_cfg, sam2_checkpoint)
-    inference_state = predictor.init_state(video_path=video_dir)
+    inference_state = predictor.init_state(
+        frames_tensor=frames_tensor[start_idx : end_idx + 1]
+    )
 
     for prompt_info in clip_prompts:
         prompt_objs = prompt_info.prompt_objs
@@ -547,10 +917,10 @@ def process_video_clip(frames, clip_prompts: List[PromptInfo], clip_range: ClipR
             prompt_type,
         )
 
-    video_segments = predict_on_video(predictor, inference_state, start_idx)
-
-    del predictor
-    torch.cuda.empty_cache()
+    first_prompt_frame_idx = min(p.frame_idx for p in clip_prompts) - start_idx
+    video_segments = predict_on_video(
+        predictor, inference_state, start_idx, first_prompt_frame_idx, mask_staging
+    )
 
     return video_segments
 
@@ -565,12 +935,7 @@ def get_num_categories(frame):
     Returns:
         set: Set of category IDs.
     """
-    ann_ids = COCO_INFO.getAnnIds(imgIds=frame["id"])
-    anns = COCO_INFO.loadAnns(ann_ids)
-    cat_set = set()
-    for ann in anns:
-        cat_set.add(ann["category_id"])
-    return cat_set
+    return {ann["category_id"] for ann in ANN_BY_IMG.get(frame["id"], ())}
 
 
 def generate_prompts_by_categories(frames, prompt_type: str):
@@ -583,10 +948,11 @@ def generate_prompts_by_categories(frames, prompt_type: str):
         if frame["is_det_keyframe"] is False:
             continue
         # ic(get_num_categories(frame))
-        if get_num_categories(frame).issubset(existing_cats):
+        frame_cats = get_num_categories(frame)
+        if frame_cats.issubset(existing_cats):
             continue
 
-        diff_cats = get_num_categories(frame).difference(existing_cats)
+        diff_cats = frame_cats.difference(existing_cats)
         existing_cats = existing_cats.union(diff_cats)
 
         prompt_objs = get_each_obj(frame)
@@ -746,24 +1112,46 @@ def merge_prompts(prompts_by_categories, prompts_by_clip_length):
 
 
 def process_singel_video(
-    frames, prompt_type, clip_length: int = None, variable_cats: bool = False
+    predictor,
+    frames,
+    prompt_type,
+    clip_length: int = None,
+    variable_cats: bool = False,
 ):
     """
     Process a single video.
 
     Args:
+        predictor (object): Predictor object shared by all clips.
         frames (list): List of frame information.
         prompt_type (str): Type of prompt (points, bbox, mask).
         clip_length (int): Length of the clip.
         variable_cats (bool): Whether to use variable categories for prompts.
 
     Returns:
-        dict: Dictionary containing video segments.
+        tuple: Frames sorted by order in video, and a list with the segments of
+            each of those frames (None for frames that were not tracked).
     """
-    global OBJ_COUNT
+    global OBJ_COUNT, ANN_BY_IMG
     OBJ_COUNT = 0
-
-    video_segments = {}
+    frames = sort_dicts_by_field(frames, "order_in_video")
+    ANN_BY_IMG = index_annotations_by_image(frames)
+
+    video_segments = [None] * len(frames)
+    frames_tensor = load_frames_to_tensor(frames)
+    # the tracked objects are the annotated ones, so a frame has at most as many
+    # categories as the video's annotations
+    num_cats = len(
+        {ann["category_id"] for anns in ANN_BY_IMG.values() for ann in anns}
+    )
+    # allocated once per video and reused by every clip and frame
+    mask_staging = MaskStaging(
+        MASK_STAGING_SLOTS,
+        len(frames),
+        num_cats,
+        frames_tensor.shape[-2],
+        frames_tensor.shape[-1],
+    )
 
     if variable_cats:
         prompts_by_categories = generate_prompts_by_categories(frames, prompt_type)
@@ -779,32 +1167,34 @@ def process_singel_video(
     for clip_prompts, clip_range in gen_clip_prompts:
         save_prompt_frame(clip_prompts)
         logger.info(clip_range)
-        video_segments.update(process_video_clip(frames, clip_prompts, clip_range))
+        clip_segments = process_video_clip(
+            predictor, frames_tensor, mask_staging, clip_prompts, clip_range
+        )
+        for frame_idx, segment in clip_segments.items():
+            video_segments[frame_idx] = segment
 
-    torch.cuda.empty_cache()
-    return video_segments
+    return frames, video_segments
 
 
-def process_all_videos(prompt_type, clip_length, variable_cats):
+def process_all_videos(predictor, prompt_type, clip_length, variable_cats):
     """
     Process all videos.
 
     Args:
+        predictor (object): Predictor object shared by all videos.
         prompt_type (str): Type of prompt (points, bbox, mask).
         clip_length (int): Length of the clip.
 
     Returns:
-        dict: Dictionary containing all video segments.
+        dict: Sorted frames and their segments for each video.
     """
     all_video_segments = {}
     for video_id in VIDEO_ID_SET:
         logger.info(f"video_id: {video_id}")
         frames = get_dicts_by_field_value(get_imgs(COCO_INFO), "video_id", video_id)
-        video_segments = process_singel_video(
-            frames, prompt_type, clip_length, variable_cats
+        all_video_segments[video_id] = process_singel_video(
+            predictor, frames, prompt_type, clip_length, variable_cats
         )
-        all_video_segments[video_id] = video_segments
-        torch.cuda.empty_cache()
         free_memory, total_memory = torch.cuda.mem_get_info()
         logger.info(f"free memory: {free_memory/1024**3:.2f} GB\n")
 
@@ -815,8 +1205,12 @@ def save_as_coco_format(all_video_segments, save_video_list):
     """
     Save the results in COCO format.
 
+    Large outputs are encoded in parallel by a pool of spawned workers running
+    coco_encode, which does not import torch; each task carries a chunk of
+    frames with their non-empty masks only.
+
     Args:
-        all_video_segments (dict): Dictionary containing all video segments.
+        all_video_segments (dict): Sorted frames and their segments for each video.
         save_video_list (list): The videos to save.
 
     Returns:
@@ -827,48 +1221,34 @@ def save_as_coco_format(all_video_segments, save_video_list):
     if save_video_list is None:
         save_video_list = VIDEO_ID_SET
 
+    encode_list = []
     for video_id in save_video_list:
-        video_segments = all_video_segments[video_id]
-
-        frames = get_dicts_by_field_value(get_imgs(COCO_INFO), "video_id", video_id)
-        frames = sort_dicts_by_field(frames, "order_in_video")
+        frames, video_segments = all_video_segments[video_id]
 
-        for frame in frames:
+        for frame, segment in zip(frames, video_segments):
             # if frame["is_det_keyframe"] is False:
             #     continue
+            if segment is None:
+                continue
+            segment = drop_empty_masks(segment)
+            if segment is None:
+                continue
+            encode_list.append((frame["id"], segment))
 
-            merged_mask = {}
-
-            ## merge the mask
-            for key, mask_info in video_segments[frame["order_in_video"]].items():
-                remainder = key % MOD
-                m_mask = np.logical_or.reduce(
-                    mask_info["mask"], axis=0
-                )  # 使用 mask_info['mask']
-                score = mask_info["score"]  # 获取 score
-
-                if remainder not in merged_mask:
-                    merged_mask[remainder] = m_mask
-                else:
-                    merged_mask[remainder] = np.logical_or(
-                        merged_mask[remainder], m_mask
-                    )
-
-            for key, mask in merged_mask.items():
-                if mask.sum() == 0:
-                    continue
-
-                rle = maskUtils.encode(np.asfortranarray(mask))
-                rle["counts"] = rle["counts"].decode("utf-8")
-                annotation = {
-                    "image_id": frame["id"],
-                    "category_id": key,
-                    "segmentation": rle,
-                    "bbox": mask_to_bbox(mask),  # 添加 bbox 字段
-                    "iscrowd": 0,
-                    "score": score,  # 添加 score 字段
-                }
-                coco_annotations.append(annotation)
+    chunks = [
+        encode_list[start : start + ENCODE_CHUNKSIZE]
+        for start in range(0, len(encode_list), ENCODE_CHUNKSIZE)
+    ]
+    if ENCODE_WORKERS > 1 and len(encode_list) >= ENCODE_PARALLEL_MIN_FRAMES:
+        with ProcessPoolExecutor(
+            max_workers=min(ENCODE_WORKERS, len(chunks)),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            for annotations in executor.map(encode_frames, chunks):
+                coco_annotations.extend(annotations)
+    else:
+        for chunk in chunks:
+            coco_annotations.extend(encode_frames(chunk))
 
     predict_data = coco_annotations
 
@@ -876,7 +1256,7 @@ def save_as_coco_format(all_video_segments, save_video_list):
     prompt_path = os.path.join(OUTPUT_PATH, "prompt.pkl")
 
     with open(predict_path, "w") as f:
-        json.dump(predict_data, f, indent=4)
+        json.dump(predict_data, f, separators=(",", ":"))
 
     with open(prompt_path, "wb") as f:
         pickle.dump(PROMPT_INFO, f)
@@ -921,6 +1301,7 @@ def inference(
         NOISE_ADDER, \
         NUM_NEG_POINTS, \
         INCLUDE_CENTER
+    setup_torch()
     NUM_NEG_POINTS = num_neg_points
     NUM_POINTS = num_points
     INCLUDE_CENTER = include_center
@@ -931,7 +1312,7 @@ def inference(
     OUTPUT_PATH = os.path.join("output", prompt_type, output_path)
     os.makedirs(OUTPUT_PATH, exist_ok=True)
 
-    COCO_INFO = COCO(coco_path)
+    COCO_INFO = load_coco(coco_path)
     MOD = max(COCO_INFO.getCatIds()) + 1
 
     img_ids = COCO_INFO.getImgIds()
@@ -942,7 +1323,17 @@ def inference(
 
     logger.add("output/log.log")
 
-    all_videos_segments = process_all_videos(prompt_type, clip_length, variable_cats)
+    predictor = build_sam2_video_predictor(
+        model_cfg,
+        sam2_checkpoint,
+        # replay the image encoder from a CUDA graph, all frames share one size
+        hydra_overrides_extra=["++model.use_cuda_graph_image_encoder=true"],
+    )
+    all_videos_segments = process_all_videos(
+        predictor, prompt_type, clip_length, variable_cats
+    )
+    del predictor
+    torch.cuda.empty_cache()
 
     predict_path, prompt_path = save_as_coco_format(
         all_videos_segments, save_video_list
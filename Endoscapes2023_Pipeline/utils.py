@@ -6,6 +6,11 @@ import matplotlib.pyplot as plt
 import numpy as np
 from natsort import natsorted
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional, masks_to_bboxes falls back to NumPy
+    njit = None
+
 
 @dataclass
 class ClipRange:
@@ -26,11 +31,66 @@ class PromptObj:
     pos_or_neg_label: List[int]
 
 
+@dataclass
+class ObjBatch:
+    """Struct of arrays for storing the prompt objects of one frame."""
+
+    masks: np.ndarray  # (K, H, W) bool
+    bboxes: np.ndarray  # (K, 4) float, [xmin, ymin, xmax, ymax]
+    points: np.ndarray  # (K, P, 2)
+    pos_or_neg_labels: np.ndarray  # (K, P)
+    obj_ids: np.ndarray  # (K,) int
+
+    @classmethod
+    def stack(cls, masks, bboxes, points, pos_or_neg_labels, obj_ids, height, width):
+        """
+        Stack per-object lists into a batch.
+        """
+        if len(masks) == 0:
+            return cls(
+                masks=np.zeros((0, height, width), dtype=bool),
+                bboxes=np.zeros((0, 4), dtype=np.float64),
+                points=np.zeros((0, 0, 2), dtype=np.int64),
+                pos_or_neg_labels=np.zeros((0, 0), dtype=np.int32),
+                obj_ids=np.zeros((0,), dtype=np.int64),
+            )
+        masks = np.stack(masks)
+        return cls(
+            masks=masks,
+            bboxes=np.stack(bboxes),
+            points=np.stack(points),
+            pos_or_neg_labels=np.stack(pos_or_neg_labels),
+            obj_ids=np.asarray(obj_ids, dtype=np.int64),
+        )
+
+    def __len__(self):
+        return len(self.obj_ids)
+
+    def __getitem__(self, idx) -> PromptObj:
+        return PromptObj(
+            mask=self.masks[idx],
+            bbox=self.bboxes[idx].tolist(),
+            points=self.points[idx],
+            obj_id=int(self.obj_ids[idx]),
+            pos_or_neg_label=self.pos_or_neg_labels[idx],
+        )
+
+    def __setitem__(self, idx, obj: PromptObj):
+        self.masks[idx] = obj.mask
+        self.bboxes[idx] = obj.bbox
+        self.points[idx] = obj.points
+        self.pos_or_neg_labels[idx] = obj.pos_or_neg_label
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
 @dataclass
 class PromptInfo:
     """Typed dictionary for storing prompt information."""
 
-    prompt_objs: List[PromptObj]
+    prompt_objs: ObjBatch
     frame_idx: int
     prompt_type: str
     video_id: str
@@ -89,25 +149,34 @@ def show_box(box, ax):
     )
 
 
-def mask_to_masks(mask: np.ndarray) -> list:
+def mask_to_components(mask: np.ndarray):
+    """
+    Splits a binary mask into connected components with a single labelling pass.
+
+    Returns the component masks as a (K, H, W) bool array and their bounding
+    boxes, read from the component stats, as a (K, 4) array of
+    [xmin, ymin, xmax, ymax] matching `mask_to_bbox`.
+    """
     kernel = np.ones((5, 5), np.uint8)  # 可以调整核的大小来控制闭运算程度
 
     # 对 mask 进行闭运算
     closed_mask = cv2.morphologyEx(mask.astype(np.uint8), cv2.MORPH_CLOSE, kernel)
 
     num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(
-        closed_mask.astype(np.uint8)
+        closed_mask, connectivity=8, ltype=cv2.CV_32S
     )
-    binary_masks = []
     min_area = 10  # 设置最小连通区域面积
-    for i in range(1, num_labels):  # 从 1 开始，因为 0 表示背景
-        area = stats[i, cv2.CC_STAT_AREA]
-        if area >= min_area:  # 过滤面积过小的连通区域
-            # 生成只包含当前连通区域的二值mask
-            binary_mask = labels == i
-            binary_masks.append(binary_mask)
+    # 从 1 开始，因为 0 表示背景; 过滤面积过小的连通区域
+    keep = np.flatnonzero(stats[1:num_labels, cv2.CC_STAT_AREA] >= min_area) + 1
 
-    return binary_masks
+    binary_masks = labels[None] == keep[:, None, None]
+    xmin = stats[keep, cv2.CC_STAT_LEFT]
+    ymin = stats[keep, cv2.CC_STAT_TOP]
+    xmax = xmin + stats[keep, cv2.CC_STAT_WIDTH] - 1
+    ymax = ymin + stats[keep, cv2.CC_STAT_HEIGHT] - 1
+    bboxes = np.stack([xmin, ymin, xmax, ymax], axis=1).astype(np.float64)
+
+    return binary_masks, bboxes
 
 
 def mask_to_points(mask, num_points=0, include_center=False):
@@ -152,3 +221,54 @@ def mask_to_bbox(mask):
     xmin, ymin = np.min(pos[1]), np.min(pos[0])
     xmax, ymax = np.max(pos[1]), np.max(pos[0])
     return [float(xmin), float(ymin), float(xmax), float(ymax)]
+
+
+if njit is not None:
+
+    @njit(parallel=True, cache=True)
+    def _bbox_kernel(masks):
+        num_masks, height, width = masks.shape
+        bboxes = np.empty((num_masks, 4), dtype=np.float64)
+        for k in prange(num_masks):
+            xmin, ymin, xmax, ymax = width, height, -1, -1
+            for y in range(height):
+                row_hit = False
+                for x in range(width):
+                    if masks[k, y, x]:
+                        row_hit = True
+                        xmin = min(xmin, x)
+                        xmax = max(xmax, x)
+                if row_hit:
+                    ymin = min(ymin, y)
+                    ymax = y
+            bboxes[k, 0] = xmin
+            bboxes[k, 1] = ymin
+            bboxes[k, 2] = xmax
+            bboxes[k, 3] = ymax
+        return bboxes
+
+else:
+    _bbox_kernel = None
+
+
+def _masks_to_bboxes_numpy(masks):
+    _, height, width = masks.shape
+    ys = np.any(masks, axis=2)
+    xs = np.any(masks, axis=1)
+    ymin = ys.argmax(axis=1)
+    ymax = height - 1 - ys[:, ::-1].argmax(axis=1)
+    xmin = xs.argmax(axis=1)
+    xmax = width - 1 - xs[:, ::-1].argmax(axis=1)
+    return np.stack([xmin, ymin, xmax, ymax], axis=1).astype(np.float64)
+
+
+def masks_to_bboxes(masks):
+    """
+    Extracts the bounding boxes from a stack of non-empty binary masks.
+
+    Returns a (K, 4) array of [xmin, ymin, xmax, ymax], matching `mask_to_bbox`.
+    Uses a parallel Numba kernel over the masks when numba is installed.
+    """
+    if _bbox_kernel is not None:
+        return _bbox_kernel(np.ascontiguousarray(masks).view(np.uint8))
+    return _masks_to_bboxes_numpy(masks)
@@ -12,7 +12,12 @@ import torch
 from tqdm import tqdm
 
 from sam2.modeling.sam2_base import NO_OBJ_SCORE, SAM2Base
-from sam2.utils.misc import concat_points, fill_holes_in_mask_scores, load_video_frames
+from sam2.utils.misc import (
+    concat_points,
+    fill_holes_in_mask_scores,
+    load_video_frames,
+    load_video_frames_from_tensor,
+)
 
 
 class SAM2VideoPredictor(SAM2Base):
@@ -28,6 +33,9 @@ class SAM2VideoPredictor(SAM2Base):
         clear_non_cond_mem_around_input=False,
         # whether to also clear non-conditioning memory of the surrounding frames (only effective when `clear_non_cond_mem_around_input` is True).
         clear_non_cond_mem_for_multi_obj=False,
+        # whether to capture the image encoder in a CUDA graph on the first frame and replay it
+        # on the following frames of the same size (removes per-kernel launch overhead)
+        use_cuda_graph_image_encoder=False,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -35,24 +43,43 @@ class SAM2VideoPredictor(SAM2Base):
         self.non_overlap_masks = non_overlap_masks
         self.clear_non_cond_mem_around_input = clear_non_cond_mem_around_input
         self.clear_non_cond_mem_for_multi_obj = clear_non_cond_mem_for_multi_obj
+        self.use_cuda_graph_image_encoder = use_cuda_graph_image_encoder
+        # (graph, static input, static output) once captured
+        self._image_encoder_graph = None
 
     @torch.inference_mode()
     def init_state(
         self,
-        video_path,
+        video_path=None,
         offload_video_to_cpu=False,
         offload_state_to_cpu=False,
         async_loading_frames=False,
+        frames_tensor=None,
     ):
-        """Initialize a inference state."""
+        """
+        Initialize a inference state.
+
+        The frames are read either from a JPEG folder `video_path` or from
+        `frames_tensor`, a preloaded uint8 RGB tensor of shape (F, 3, H, W).
+        """
         compute_device = self.device  # device of the model
-        images, video_height, video_width = load_video_frames(
-            video_path=video_path,
-            image_size=self.image_size,
-            offload_video_to_cpu=offload_video_to_cpu,
-            async_loading_frames=async_loading_frames,
-            compute_device=compute_device,
-        )
+        if frames_tensor is not None:
+            images, video_height, video_width = load_video_frames_from_tensor(
+                frames_tensor=frames_tensor,
+                image_size=self.image_size,
+                offload_video_to_cpu=offload_video_to_cpu,
+                compute_device=compute_device,
+            )
+        elif video_path is not None:
+            images, video_height, video_width = load_video_frames(
+                video_path=video_path,
+                image_size=self.image_size,
+                offload_video_to_cpu=offload_video_to_cpu,
+                async_loading_frames=async_loading_frames,
+                compute_device=compute_device,
+            )
+        else:
+            raise ValueError("either video_path or frames_tensor must be provided")
         inference_state = {}
         inference_state["images"] = images
         inference_state["num_frames"] = len(images)
@@ -788,6 +815,63 @@ class SAM2VideoPredictor(SAM2Base):
         inference_state["tracking_has_started"] = False
         inference_state["frames_already_tracked"].clear()
 
+    def _capture_image_encoder_graph(self, image):
+        """
+        Capture `forward_image` on static buffers shaped like `image`.
+
+        The graph is checked once against the eager `forward_image` on `image`; if the
+        outputs differ, the graph is dropped and the eager path is used from then on.
+        """
+        static_input = image.clone()
+        # CUDA graph capture requires the autocast weight cache to be disabled, otherwise
+        # the graph would read the cache's bf16 weight copies
+        with torch.autocast("cuda", dtype=torch.bfloat16, cache_enabled=False):
+            # warm up on a side stream so that lazy initializations (e.g. cuDNN
+            # autotuning or cached position encodings) happen outside of the capture
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(2):
+                    self.forward_image(static_input)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_output = self.forward_image(static_input)
+
+            expected = self.forward_image(image)
+        graph.replay()
+        if not _backbone_out_close(static_output, expected):
+            warnings.warn(
+                "CUDA graph replay of the image encoder does not match the eager "
+                "forward pass; falling back to the eager image encoder."
+            )
+            self.use_cuda_graph_image_encoder = False
+            return
+        self._image_encoder_graph = (graph, static_input, static_output)
+
+    def _run_image_encoder(self, image):
+        """
+        Compute the image features, replaying the captured CUDA graph if enabled.
+
+        The graph's static outputs are shared by every inference state of this predictor
+        and overwritten by the next replay, so they are cloned before being returned.
+        Inputs of another shape or on another device fall back to the eager path.
+        """
+        if not self.use_cuda_graph_image_encoder or image.device.type != "cuda":
+            return self.forward_image(image)
+        if self._image_encoder_graph is None:
+            self._capture_image_encoder_graph(image)
+            if self._image_encoder_graph is None:
+                return self.forward_image(image)
+        graph, static_input, static_output = self._image_encoder_graph
+        if image.shape != static_input.shape or image.dtype != static_input.dtype:
+            return self.forward_image(image)
+
+        static_input.copy_(image)
+        graph.replay()
+        return _clone_backbone_out(static_output)
+
     def _get_image_feature(self, inference_state, frame_idx, batch_size):
         """Compute the image features on a given frame."""
         # Look up in the cache first
@@ -798,7 +882,7 @@ class SAM2VideoPredictor(SAM2Base):
             # Cache miss -- we will run inference on a single image
             device = inference_state["device"]
             image = inference_state["images"][frame_idx].to(device).float().unsqueeze(0)
-            backbone_out = self.forward_image(image)
+            backbone_out = self._run_image_encoder(image)
             # Cache the most recent frame's feature (for repeated interactions with
             # a frame; we can use an LRU cache for more frames in the future).
             inference_state["cached_features"] = {frame_idx: (image, backbone_out)}
@@ -959,3 +1043,22 @@ class SAM2VideoPredictor(SAM2Base):
             non_cond_frame_outputs.pop(t, None)
             for obj_output_dict in inference_state["output_dict_per_obj"].values():
                 obj_output_dict["non_cond_frame_outputs"].pop(t, None)
+
+
+def _clone_backbone_out(backbone_out):
+    """Clone the tensors of a `forward_image` output, including those in lists."""
+    return {
+        k: [x.clone() for x in v] if isinstance(v, list) else v.clone()
+        for k, v in backbone_out.items()
+    }
+
+
+def _backbone_out_close(backbone_out, expected, rtol=1e-2, atol=1e-2):
+    """Whether two `forward_image` outputs match within bf16 tolerances."""
+    for k, v in expected.items():
+        actual = backbone_out[k]
+        pairs = zip(actual, v) if isinstance(v, list) else [(actual, v)]
+        for a, b in pairs:
+            if not torch.allclose(a.float(), b.float(), rtol=rtol, atol=atol):
+                return False
+    return True
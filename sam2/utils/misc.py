@@ -10,6 +10,7 @@ from threading import Thread
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from PIL import Image
 from tqdm import tqdm
 import re
@@ -259,6 +260,54 @@ def load_video_frames(
     return images, video_height, video_width
 
 
+def load_video_frames_from_tensor(
+    frames_tensor,
+    image_size,
+    offload_video_to_cpu,
+    img_mean=(0.485, 0.456, 0.406),
+    img_std=(0.229, 0.224, 0.225),
+    compute_device=torch.device("cuda"),
+):
+    """
+    Load the video frames from a preloaded uint8 RGB tensor of shape (F, 3, H, W).
+
+    This skips the JPEG folder scan and decoding of `load_video_frames`. The frames are
+    resized to image_size x image_size on `compute_device` (bicubic, like the PIL path)
+    and are kept there unless `offload_video_to_cpu` is `True`.
+    """
+    num_frames, _, video_height, video_width = frames_tensor.shape
+    if num_frames == 0:
+        raise RuntimeError("no images found in the preloaded frames tensor")
+    img_mean = torch.tensor(img_mean, dtype=torch.float32, device=compute_device)
+    img_std = torch.tensor(img_std, dtype=torch.float32, device=compute_device)
+
+    images = torch.zeros(
+        num_frames,
+        3,
+        image_size,
+        image_size,
+        dtype=torch.float32,
+        device=compute_device,
+    )
+    for n in tqdm(range(num_frames), desc="frame loading (tensor)"):
+        img = frames_tensor[n : n + 1].to(compute_device, non_blocking=True)
+        images[n] = F.interpolate(
+            img.float() / 255.0,
+            size=(image_size, image_size),
+            mode="bicubic",
+            align_corners=False,
+            antialias=True,
+        )[0]
+    # bicubic may overshoot; clamp to the range the 8-bit PIL path produces
+    images.clamp_(0.0, 1.0)
+    # normalize by mean and std
+    images -= img_mean[:, None, None]
+    images /= img_std[:, None, None]
+    if offload_video_to_cpu:
+        images = images.cpu()
+    return images, video_height, video_width
+
+
 def fill_holes_in_mask_scores(mask, max_area):
     """
     A post processor to fill small holes in mask scores with area under `max_area`.